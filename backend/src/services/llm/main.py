@@ -1,10 +1,15 @@
 import os 
 import json
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from uuid import uuid4
 
 
+import numpy as np
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, VectorParams, Distance
+from qdrant_client.models import Batch, PointStruct, VectorParams, Distance
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sentence_transformers import SentenceTransformer
 from yandex_gpt import YandexGPT, YandexGPTConfigManagerForAPIKey
@@ -12,38 +17,72 @@ from dotenv import load_dotenv
 from typing import Any
 
 
-from .prompts import chunking_prompt, main_prompt
+from .prompts.chunking_prompt import chunking_prompt
+from .prompts.main_prompt import main_prompt, rag_context_prompt
 
 
 load_dotenv("./env/llm.env")
 YANDEX_API_KEY = os.getenv("YANDEX_API_KEY")
 CATALOG_ID = os.getenv("CATALOG_ID")
+logger = logging.getLogger(__name__)
+LLM_MAX_WORKERS = 4
+EMBEDDING_CACHE_SIZE = 1024
+INGEST_BATCH_SIZE = 256
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=300,
+    chunk_overlap=50,
+    separators=["\n\n","\n", ". ", "! ", "? ", ]
+)
+
+
+@lru_cache(maxsize=None)
+def _load_embedding_model(model_name: str) -> SentenceTransformer:
+    return SentenceTransformer(model_name)
 
 
 class RAGModel:
     def __init__(self) -> None:
         self.qdrant = QdrantClient(":memory:", prefer_grpc=False)
-        self.embedding_model = SentenceTransformer("ai-forever/ru-en-RoSBERTa")
+        self.embedding_model = _load_embedding_model("ai-forever/ru-en-RoSBERTa")
         self.llm_model = YandexGPT(config_manager=YandexGPTConfigManagerForAPIKey(
                                                                                 model_type="yandexgpt",
                                                                                 catalog_id=CATALOG_ID,
                                                                                 api_key=YANDEX_API_KEY
         ))
+        self.embedding_cache: OrderedDict[str, np.ndarray] = OrderedDict()
 
 
-    def get_embeddings(self, text:str, task:str="поиск по документам") -> list[float]:
+    def get_embeddings(self, text:str, task:str="поиск по документам") -> np.ndarray:
         prefixed_text: str = f"{task}: {text}"
-        embedding: list[float] = self.embedding_model.encode(
+        cached: np.ndarray | None = self.embedding_cache.get(prefixed_text)
+        if cached is not None:
+            self.embedding_cache.move_to_end(prefixed_text)
+            return cached
+
+        embedding: np.ndarray = self.embedding_model.encode(
             prefixed_text,
             normalize_embeddings=True,
-            convert_to_numpy=False,
             show_progress_bar=False
-        ).tolist()
+        )
+        embedding.setflags(write=False)
+        self.embedding_cache[prefixed_text] = embedding
+        if len(self.embedding_cache) > EMBEDDING_CACHE_SIZE:
+            self.embedding_cache.popitem(last=False)
         return embedding
 
 
+    def get_embeddings_batch(self, texts: list[str], task: str="поиск по документам") -> list[list[float]]:
+        prefixed_texts: list[str] = [f"{task}: {text}" for text in texts]
+        embeddings: list[list[float]] = self.embedding_model.encode(
+            prefixed_texts,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        ).tolist()
+        return embeddings
+
+
     def create_collection(self, collection_name: str) -> None:
-        size = len(self.get_embeddings("test"))
+        size = self.embedding_model.get_sentence_embedding_dimension() or len(self.get_embeddings("test"))
         self.qdrant.create_collection(
             collection_name=collection_name,
             vectors_config=VectorParams(size=size, distance=Distance.COSINE)
@@ -56,21 +95,28 @@ class RAGModel:
             points=[
                 PointStruct(
                     id=str(uuid4().hex),
-                    vector=self.get_embeddings(text),
+                    vector=self.get_embeddings_batch([text])[0],
                     payload=payload
                 )
             ])
 
 
+    def add_points(self, collection_name: str, texts: list[str], payloads: list[dict[str, Any]]) -> None:
+        if not texts:
+            return
+        self.qdrant.upsert(
+            collection_name=collection_name,
+            points=Batch(
+                ids=[str(uuid4().hex) for _ in texts],
+                vectors=self.get_embeddings_batch(texts),
+                payloads=payloads
+            ))
+
+
     @staticmethod
     def make_chunks(long_text: str) -> list[str]:
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=300,
-            chunk_overlap=50,
-            separators=["\n\n","\n", ". ", "! ", "? ", ]
-        )
-        chunks: list[str] = splitter.split_text(long_text)
-        print(chunks)
+        chunks: list[str] = TEXT_SPLITTER.split_text(long_text)
+        logger.debug("Text split into chunks: %s", chunks)
         return chunks
 
 
@@ -84,31 +130,47 @@ class RAGModel:
         return result
 
 
-    def read_json_and_add_point(self, doc_path: str, collection_name: str) -> None:
-        with open(doc_path, 'r') as file:
-            data = json.loads(file.read())
-            for doc in data.get('documents'):
-                if doc.get('text_entities'):
-                    full_text: list[str] = []
-                    for text in doc.get('text_entities'):
-                        if text.get('type') == 'plain':
-                            clear_text = text.get('text').replace('\n', ' ').strip().lower()
-                            full_text.append(clear_text)
-
-
-                    text_to_embedd = ' '.join(full_text)
-                    text_to_embedd = self.clear_text_to_embedding(text_to_embedd)
-                    text_chunks = self.make_chunks(text_to_embedd)
-                
-                    for chunk in text_chunks:
-                        payload = {
-                            "content": chunk,
-                            "metadata": { 
-                                "doc_name": doc.get('doc_name'),
-                                "doc_chapter": doc.get('doc_chapter')
-                            }
+    def read_json_chunks(self, doc_path: str) -> tuple[list[str], list[dict[str, Any]]]:
+        try:
+            with open(doc_path, 'r') as file:
+                data = json.loads(file.read())
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error("Skipping %s, failed to read: %s", doc_path, e)
+            return [], []
+
+        docs_to_embedd: list[dict[str, Any]] = []
+        raw_texts: list[str] = []
+        for doc in data.get('documents', []):
+            if doc.get('text_entities'):
+                full_text: list[str] = []
+                for text in doc.get('text_entities'):
+                    if text.get('type') == 'plain':
+                        full_text.append(text.get('text').strip())
+
+                docs_to_embedd.append(doc)
+                raw_texts.append(' '.join(full_text).replace('\n', ' ').lower())
+
+        texts: list[str] = []
+        payloads: list[dict[str, Any]] = []
+        with ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS) as executor:
+            cleared_texts = executor.map(self.clear_text_to_embedding, raw_texts)
+            for doc, text_to_embedd in zip(docs_to_embedd, cleared_texts):
+                for chunk in self.make_chunks(text_to_embedd):
+                    texts.append(chunk)
+                    payloads.append({
+                        "content": chunk,
+                        "metadata": { 
+                            "doc_name": doc.get('doc_name'),
+                            "doc_chapter": doc.get('doc_chapter')
                         }
-                        self.add_point(collection_name, chunk, payload)
+                    })
+
+        return texts, payloads
+
+
+    def read_json_and_add_point(self, doc_path: str, collection_name: str) -> None:
+        texts, payloads = self.read_json_chunks(doc_path)
+        self.add_points(collection_name, texts, payloads)
 
 
     def rag_query(self, collection_name: str, user_question: str, max_context_tokens: int=1000) -> str:
@@ -116,6 +178,7 @@ class RAGModel:
             collection_name=collection_name,
             query=self.get_embeddings(user_question),
             limit=10,
+            score_threshold=0.65,
             with_payload=True
         )
         
@@ -123,37 +186,28 @@ class RAGModel:
         sources: list[str] = []
         total_tokens: int = 0
         
-        for point in search_results.points:
-            if point.score >= 0.65:
-                content: str = point.payload.get('content', '')
-                metadata: Any = point.payload.get('metadata', {})
-                source_info = f"{metadata.get('doc_name', 'Неизвестно')} ({metadata.get('doc_chapter', 'Не указано')})"
-                
-                context_parts.append(f"[Чанк {len(context_parts)+1}] {content}")
-                sources.append(source_info)
-                
-                total_tokens += len(content.split())
-                if total_tokens > max_context_tokens:
-                    break
+        for chunk_number, point in enumerate(search_results.points, start=1):
+            content: str = point.payload.get('content', '')
+            metadata: Any = point.payload.get('metadata', {})
+            source_info = f"{metadata.get('doc_name', 'Неизвестно')} ({metadata.get('doc_chapter', 'Не указано')})"
+            
+            context_parts.append(f"[Чанк {chunk_number}] {content}")
+            sources.append(source_info)
+            
+            total_tokens += len(content.split())
+            if total_tokens > max_context_tokens:
+                break
         
         if not context_parts:
             return "Извините, эта информация временно недоступна."
         
         vector_context = "\n".join(context_parts)
-        sources_list = " | ".join(sources)
+        sources_list = " | ".join(dict.fromkeys(sources))
 
         messages = [
             {
                 "role": "system", 
-                "text": f"""{main_prompt} 
-<НАЧАЛО ВЕКТОРНОГО КОНТЕКСТА>
-{vector_context}
-<КОНЕЦ ВЕКТОРНОГО КОНТЕКСТА>
-
-ВАЖНО: В конце ответа обязательно укажи источники информации в формате:
-Источники: [список документов через запятую]
-
-Пример: Источники: Трудовой кодекс РФ (Охрана труда), Правила пожарной безопасности (Общие положения)"""
+                "text": main_prompt + rag_context_prompt.format(vector_context=vector_context)
             },
             {
                 "role": "user", 
@@ -166,25 +220,42 @@ class RAGModel:
     
     def ensure_collection(self, collection_name: str) -> None:
         try:
-            collections = self.qdrant.get_collections()
-            if collection_name not in [c.name for c in collections.collections]:
+            if not self.qdrant.collection_exists(collection_name):
                 self.create_collection(collection_name)
         except Exception as e:
-            print(f"An error occured: {e}")
+            logger.error("An error occured: %s", e)
 
 
     def load_documents(self, docs_path: str, collection_name: str) -> None:
         self.ensure_collection(collection_name)
-        try:
-            if os.path.isdir(docs_path):
-                for doc in os.listdir(docs_path):
-                    if doc.endswith(".json"):
-                        self.read_json_and_add_point(os.path.join(docs_path, doc), collection_name)
-            else:
-                if docs_path.endswith(".json"):
-                    self.read_json_and_add_point(docs_path, collection_name)
-        except Exception as e:
-            print(f"An error occured: {e}")
+        if os.path.isdir(docs_path):
+            with os.scandir(docs_path) as entries:
+                doc_paths: list[str] = [
+                    entry.path for entry in entries
+                    if entry.name.endswith(".json") and entry.is_file()
+                ]
+
+            texts: list[str] = []
+            payloads: list[dict[str, Any]] = []
+            error: Exception | None = None
+            for doc_path in doc_paths:
+                try:
+                    doc_texts, doc_payloads = self.read_json_chunks(doc_path)
+                except Exception as e:
+                    error = e
+                    break
+                texts.extend(doc_texts)
+                payloads.extend(doc_payloads)
+                if len(texts) >= INGEST_BATCH_SIZE:
+                    batch_texts, batch_payloads, texts, payloads = texts, payloads, [], []
+                    self.add_points(collection_name, batch_texts, batch_payloads)
+
+            self.add_points(collection_name, texts, payloads)
+            if error is not None:
+                raise error
+        else:
+            if docs_path.endswith(".json"):
+                self.read_json_and_add_point(docs_path, collection_name)
 
 
     def ask(self, user_question: str, collection_name: str) -> str:
@@ -192,3 +263,11 @@ class RAGModel:
     
     def close(self) -> None:
         self.qdrant.close()
+
+
+    def __enter__(self) -> "RAGModel":
+        return self
+
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
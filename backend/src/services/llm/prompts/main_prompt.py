@@ -44,3 +44,14 @@ main_prompt = f"""
 - Избегай markdown-разметки
 - ОБЯЗАТЕЛЬНО указывай источники в формате выше
 """
+
+
+rag_context_prompt = """ 
+<НАЧАЛО ВЕКТОРНОГО КОНТЕКСТА>
+{vector_context}
+<КОНЕЦ ВЕКТОРНОГО КОНТЕКСТА>
+
+ВАЖНО: В конце ответа обязательно укажи источники информации в формате:
+Источники: [список документов через запятую]
+
+Пример: Источники: Трудовой кодекс РФ (Охрана труда), Правила пожарной безопасности (Общие положения)"""